@@ -1,38 +1,76 @@
 import os
-import json
+import queue
+import logging
+import logging.handlers
+import time
 import uuid
 import base64
 import asyncio
+import hashlib
+import signal
 import secrets
+import heapq
+import functools
+import contextlib
 import subprocess
 from pathlib import Path
 from datetime import datetime, timedelta
-from aiohttp import web, WSMsgType, ClientSession
+from aiohttp import web, WSMsgType, ClientSession, TCPConnector
 import aiosqlite
-from aiogram import Bot, Dispatcher, types, F
+import orjson
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from aiogram import Bot, Dispatcher, Router, types, F
 from aiogram.filters import CommandStart, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import LabeledPrice, PreCheckoutQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
 from dotenv import load_dotenv
 
 load_dotenv()
 
+log_queue = queue.SimpleQueue()
+logging.basicConfig(level=os.getenv("LOGLEVEL", "WARNING"), handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+logger = logging.getLogger("nefrit")
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "mellfreezy")
+ADMIN_USERNAME_LC = ADMIN_USERNAME.lower()
+ADMIN_IDS = frozenset(int(admin_id) for admin_id in os.getenv("ADMINS", "").split(",") if admin_id.strip())
 BASE_URL = os.getenv("BASE_URL", "https://nefrit-master.onrender.com")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "nefrit_vpn_bot")
 SERVER_SECRET = os.getenv("SERVER_SECRET", "default-secret")
 PORT = int(os.getenv("PORT", 8080))
 XRAY_PORT = 10001
+TUNNEL_CHUNK = 65536
+XRAY_API_PORT = 10085
+XRAY_API_ADDR = "127.0.0.1:" + str(XRAY_API_PORT)
+XRAY_INBOUND_TAG = "vless-in"
+XRAY_BIN = "/usr/local/bin/xray"
+XRAY_RELOAD_DELAY = 0.5
+XRAY_READY_TIMEOUT = 5
+XRAY_API_CONCURRENCY = 16
 
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 DB_PATH = DATA_DIR / "vpn.db"
+READ_POOL_SIZE = 4
+SQL_STATEMENT_CACHE = 256
+SUB_CACHE_TTL = 60
+STATS_CACHE_TTL = 5
+WEB_CONCURRENCY = 256
+KEYS_BATCH_MAX = 50
+KEYS_PAGE_SIZE = 20
 XRAY_CONFIG_PATH = DATA_DIR / "xray_config.json"
+XRAY_LOG_PATH = DATA_DIR / "xray.log"
 
 SUPPORT_USERNAME = "mellfreezy"
 CHANNEL_USERNAME = "nefrit_vpn"
@@ -78,14 +116,59 @@ PRICES = {
     "year": {"days": 365, "stars": 100, "name": "1 год"},
     "forever": {"days": None, "stars": 500, "name": "Навсегда"}
 }
+PLAN_INVOICES = {
+    plan: {
+        "title": f"Nefrit VPN - {info['name']}",
+        "description": f"Подписка на VPN: {info['name']}",
+        "payload": f"vpn_{plan}",
+        "provider_token": "",
+        "currency": "XTR",
+        "prices": [LabeledPrice(label=info["name"], amount=info["stars"])]
+    }
+    for plan, info in PRICES.items()
+}
 
 TRIAL_DAYS = 3
 TRIAL_DAYS_REFERRAL = 3
 REFERRAL_BONUS_DAYS = 3
 
+START_TEXT = "<b>Nefrit VPN</b>\n\nДобро пожаловать, {name}!\n\nБыстрый и надёжный VPN сервис.\n\nВыберите действие:"
+REFERRAL_START_TEXT = "<b>Добро пожаловать в Nefrit VPN!</b>\n\nВы пришли по реферальной ссылке!\nВам начислен пробный период на <b>{days} дней</b>!\n\n<b>Ссылка подписки:</b>\n<code>{sub_url}</code>\n\n<b>Конфиг:</b>\n<code>{link}</code>\n\n<b>Приложения:</b>\nAndroid: V2rayNG\niOS: Streisand / V2Box\nWindows: V2rayN"
+KEY_ACTIVATED_TEXT = "<b>Подписка активирована!</b>\n\n{expiry}\n\n<b>Ссылка:</b>\n<code>{sub_url}</code>\n\n<b>Конфиг:</b>\n<code>{link}</code>"
+MY_SUB_TEXT = "<b>Ваша подписка</b>\n\nСтатус: {status}\nСрок: {expiry}\n\n<b>Ссылка:</b>\n<code>{sub_url}</code>\n\n<b>Конфиг:</b>\n<code>{link}</code>"
+STATS_TEXT = "<b>Статистика</b>\n\n<b>Пользователи:</b>\nАктивных: {0}\nВсего: {1}\n\n<b>Ключи:</b>\nСвободных: {2}\nВсего: {3}\n\n<b>Доход:</b>\nВсего звёзд: {4}\n\n<b>Рефералы:</b>\nВсего приглашений: {5}"
+XRAY_RESTARTED_TEXT = "<b>Xray перезапущен!</b>"
+MENU_TEXT = "<b>Nefrit VPN</b>\n\nГлавное меню"
+BUY_TEXT = "<b>Купить подписку</b>\n\nВыберите тариф:\n\n1 неделя - 5 звёзд\n1 месяц - 10 звёзд\n1 год - 100 звёзд\nНавсегда - 300 звёзд\n\nОплата через Telegram Stars"
+TRIAL_TEXT = f"<b>Пробный период</b>\n\nАктивировать пробный период на <b>{TRIAL_DAYS} дня</b>?\n\nПробный период можно использовать только один раз."
+ENTER_KEY_TEXT = "<b>Введите ключ активации:</b>\n\nПример: NEFRIT-A1B2C3D4E5F6G7H8"
+NO_SUB_TEXT = "<b>У вас нет подписки</b>\n\nКупите или активируйте ключ."
+NEW_KEY_TEXT = f"<b>Создание ключа</b>\n\nВыберите срок действия или отправьте число дней.\nДля нескольких ключей: <code>дни количество</code> (до {KEYS_BATCH_MAX})"
+NO_KEYS_TEXT = "<b>Ключей нет</b>"
+KEYS_LIST_TEXT = "<b>Все ключи:</b>\n\nНажмите для удаления:"
+
 xray_process = None
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+http_session = None
+xray_reload_handle = None
+xray_reload_task = None
+xray_config_hash = None
+xray_live_hash = None
+xray_lock = asyncio.Lock()
+xray_api_semaphore = asyncio.Semaphore(XRAY_API_CONCURRENCY)
+db = None
+db_lock = asyncio.Lock()
+read_pool = None
+sub_cache = {}
+expiry_heap = []
+expiry_event = asyncio.Event()
+shutdown_event = asyncio.Event()
+stats_snapshot = None
+stats_inflight = None
+web_semaphore = asyncio.Semaphore(WEB_CONCURRENCY)
+active_clients = {}
+stats_cache = {"users": 0, "keys": 0, "free_keys": 0, "stars": 0, "referrals": 0}
+router = Router()
+admin_router = Router()
 
 
 class States(StatesGroup):
@@ -93,55 +176,186 @@ class States(StatesGroup):
     waiting_days = State()
 
 
+class RevokeCB(CallbackData, prefix="confirmrev"):
+    key_id: int
+
+
+class KeysPageCB(CallbackData, prefix="keys_p"):
+    page: int
+
+
+class BotSession(AiohttpSession):
+    # aiogram 3.4 exposes no connector options; revisit when bumping the pinned aiogram
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(limit_per_host=50, ttl_dns_cache=300, keepalive_timeout=75)
+
+
+class ReadPool:
+    def __init__(self, size):
+        self.size = size
+        self.queue = asyncio.Queue()
+        self.connections = []
+
+    async def open(self):
+        uri = DB_PATH.resolve().as_uri() + "?mode=ro"
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(uri, uri=True, cached_statements=SQL_STATEMENT_CACHE)
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            await conn.execute("PRAGMA cache_size=-16000")
+            await conn.execute("PRAGMA mmap_size=268435456")
+            await conn.execute("PRAGMA busy_timeout=5000")
+            self.connections.append(conn)
+            self.queue.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        conn = await self.queue.get()
+        try:
+            yield conn
+        finally:
+            self.queue.put_nowait(conn)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections.clear()
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "CREATE TABLE IF NOT EXISTS users ("
-            "id INTEGER PRIMARY KEY, "
-            "user_id INTEGER UNIQUE, "
-            "username TEXT, "
-            "user_uuid TEXT UNIQUE, "
-            "path TEXT UNIQUE, "
-            "key_id INTEGER, "
-            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
-            "expires_at TIMESTAMP, "
-            "is_active BOOLEAN DEFAULT 1, "
-            "trial_used BOOLEAN DEFAULT 0, "
-            "referred_by INTEGER DEFAULT NULL)"
-        )
-        await db.execute(
-            "CREATE TABLE IF NOT EXISTS keys ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-            "key TEXT UNIQUE, "
-            "days INTEGER, "
-            "is_used BOOLEAN DEFAULT 0, "
-            "used_by INTEGER, "
-            "used_by_username TEXT, "
-            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
-            "activated_at TIMESTAMP, "
-            "expires_at TIMESTAMP, "
-            "is_revoked BOOLEAN DEFAULT 0)"
-        )
-        await db.execute(
-            "CREATE TABLE IF NOT EXISTS payments ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-            "user_id INTEGER, "
-            "username TEXT, "
-            "amount INTEGER, "
-            "plan TEXT, "
-            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
-        )
-        await db.execute(
-            "CREATE TABLE IF NOT EXISTS referrals ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
-            "referrer_id INTEGER, "
-            "referred_id INTEGER UNIQUE, "
-            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
-            "bonus_given BOOLEAN DEFAULT 0)"
-        )
+    global db
+    db = await aiosqlite.connect(DB_PATH, cached_statements=SQL_STATEMENT_CACHE)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-64000")
+    await db.execute("PRAGMA mmap_size=268435456")
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "id INTEGER PRIMARY KEY, "
+        "user_id INTEGER UNIQUE, "
+        "username TEXT, "
+        "user_uuid TEXT UNIQUE, "
+        "key_id INTEGER, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+        "expires_at TIMESTAMP, "
+        "expires_ts INTEGER, "
+        "is_active BOOLEAN DEFAULT 1, "
+        "trial_used BOOLEAN DEFAULT 0, "
+        "referred_by INTEGER DEFAULT NULL)"
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS keys ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "key TEXT UNIQUE, "
+        "days INTEGER, "
+        "is_used BOOLEAN DEFAULT 0, "
+        "used_by INTEGER, "
+        "used_by_username TEXT, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+        "activated_at TIMESTAMP, "
+        "expires_at TIMESTAMP, "
+        "is_revoked BOOLEAN DEFAULT 0)"
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS payments ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "user_id INTEGER, "
+        "username TEXT, "
+        "amount INTEGER, "
+        "plan TEXT, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    await db.execute(
+        "CREATE TABLE IF NOT EXISTS referrals ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "referrer_id INTEGER, "
+        "referred_id INTEGER UNIQUE, "
+        "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, "
+        "bonus_given BOOLEAN DEFAULT 0)"
+    )
+    cursor = await db.execute("SELECT 1 FROM pragma_table_info('users') WHERE name = 'expires_ts'")
+    if not await cursor.fetchone():
+        await db.execute("ALTER TABLE users ADD COLUMN expires_ts INTEGER")
+        cursor = await db.execute("SELECT id, expires_at FROM users WHERE expires_at IS NOT NULL")
+        await db.executemany("UPDATE users SET expires_ts = ? WHERE id = ?", [(to_epoch(expires_at), row_id) for row_id, expires_at in await cursor.fetchall()])
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_users_active ON users(is_active)")
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_keys_state ON keys(is_used, is_revoked)")
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_users_key_id ON users(key_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_referrals_referrer ON referrals(referrer_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_payments_user ON payments(user_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS ix_users_expires_ts_active ON users(expires_ts) WHERE is_active = 1")
+    await db.commit()
+    cursor = await db.execute(
+        "SELECT (SELECT COUNT(*) FROM users), "
+        "(SELECT COUNT(*) FROM keys), "
+        "(SELECT COUNT(*) FROM keys WHERE is_used = 0 AND is_revoked = 0), "
+        "(SELECT COALESCE(SUM(amount), 0) FROM payments), "
+        "(SELECT COUNT(*) FROM referrals)"
+    )
+    row = await cursor.fetchone()
+    stats_cache.update(zip(("users", "keys", "free_keys", "stars", "referrals"), row))
+    await load_active_clients()
+    global read_pool
+    read_pool = ReadPool(READ_POOL_SIZE)
+    await read_pool.open()
+
+
+async def close_db():
+    if read_pool:
+        await read_pool.close()
+    if db:
+        await db.close()
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    async with db_lock:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await db.rollback()
+            raise
         await db.commit()
 
 
+def to_epoch(expires_at):
+    try:
+        return int(datetime.fromisoformat(expires_at).timestamp()) if expires_at else None
+    except ValueError:
+        return None
+
+
+def format_exp(expires_ts, now_ts):
+    if expires_ts is None:
+        return "Бессрочно", None
+    return time.strftime("%d.%m.%Y %H:%M", time.localtime(expires_ts)), (expires_ts - now_ts) // 86400
+
+
+def extend_expiry(expires_ts, days, now):
+    base = datetime.fromtimestamp(expires_ts) if expires_ts and expires_ts > now.timestamp() else now
+    return (base + timedelta(days=days)).isoformat()
+
+
+def path_for(user_id):
+    return "u" + str(user_id)
+
+
+def invalidate_subscription(user_id):
+    sub_cache.pop(path_for(user_id), None)
+
+
+def schedule_expiry(expires_at, user_id):
+    expires_ts = to_epoch(expires_at)
+    if expires_ts is None:
+        return
+    heapq.heappush(expiry_heap, (expires_ts, user_id))
+    if expiry_heap[0][0] == expires_ts:
+        expiry_event.set()
+
+
 async def sync_user_to_servers(user_uuid, user_path, action="add"):
     tasks = []
     for server in SERVERS:
@@ -152,388 +366,532 @@ async def sync_user_to_servers(user_uuid, user_path, action="add"):
     results = await asyncio.gather(*tasks, return_exceptions=True)
     for i, result in enumerate(results):
         if isinstance(result, Exception):
-            print(f"Failed to sync: {result}")
+            logger.warning("Failed to sync: %s", result)
 
 
 async def notify_server(server_url, user_uuid, user_path, action):
-    async with ClientSession() as session:
-        try:
-            endpoint = f"{server_url}/api/{action}_user"
-            await session.post(
-                endpoint,
-                json={"uuid": user_uuid, "path": user_path, "secret": SERVER_SECRET},
-                timeout=10
-            )
-        except Exception as e:
-            print(f"Error: {e}")
+    try:
+        endpoint = f"{server_url}/api/{action}_user"
+        async with http_session.post(
+            endpoint,
+            json={"uuid": user_uuid, "path": user_path, "secret": SERVER_SECRET},
+            timeout=10
+        ):
+            pass
+    except Exception as e:
+        logger.warning("Error notifying %s: %s", server_url, e)
+
+
+def vless_link_suffix(server):
+    host = server["url"].split("://", 1)[-1]
+    return f"@{host}:443?encryption=none&security=tls&type=ws&host={host}&path=%2Ftunnel#{server['emoji']} {server['name']} - {server['location']}"
+
+
+VLESS_SUFFIXES = {server["id"]: vless_link_suffix(server) for server in SERVERS}
 
 
 def generate_vless_link_multi(user_uuid, server):
-    host = server["url"].replace("https://", "").replace("http://", "")
-    return f"vless://{user_uuid}@{host}:443?encryption=none&security=tls&type=ws&host={host}&path=%2Ftunnel#{server['emoji']} {server['name']} - {server['location']}"
+    return "vless://" + user_uuid + VLESS_SUFFIXES[server["id"]]
 
 
+@functools.lru_cache(maxsize=4096)
 def generate_subscription_multi(user_uuid, user_path):
-    configs = []
-    for server in SERVERS:
-        vless = generate_vless_link_multi(user_uuid, server)
-        configs.append(vless)
-    all_configs = "\n".join(configs)
+    all_configs = "\n".join(generate_vless_link_multi(user_uuid, server) for server in SERVERS)
     return base64.b64encode(all_configs.encode()).decode()
 
 
-async def create_key(days=None):
-    key = "NEFRIT-" + secrets.token_hex(8).upper()
+@functools.lru_cache(maxsize=4096)
+def subscription_etag(user_uuid, user_path):
+    sub = generate_subscription_multi(user_uuid, user_path)
+    return '"' + hashlib.blake2b(sub.encode(), digest_size=8).hexdigest() + '"'
+
+
+async def create_keys(count, days=None):
     now = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO keys (key, days, created_at) VALUES (?, ?, ?)", (key, days, now))
+    params = []
+    for _ in range(count):
+        params += ("NEFRIT-" + secrets.token_bytes(8).hex().upper(), days, now)
+    async with db_lock:
+        cursor = await db.execute("INSERT INTO keys (key, days, created_at) VALUES " + ", ".join(["(?, ?, ?)"] * count) + " RETURNING key, id", params)
+        rows = await cursor.fetchall()
         await db.commit()
-        cursor = await db.execute("SELECT id FROM keys WHERE key = ?", (key,))
-        row = await cursor.fetchone()
-        key_id = row[0] if row else 0
-    return key, key_id
+    stats_cache["keys"] += count
+    stats_cache["free_keys"] += count
+    return sorted(rows, key=lambda row: row[1])
 
 
-async def check_trial_used(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT trial_used FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        return row[0] == 1 if row else False
+async def create_key(days=None):
+    return (await create_keys(1, days))[0]
 
 
-async def activate_trial(user_id, username, days):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT path, user_uuid FROM users WHERE user_id = ?", (user_id,))
-        existing = await cursor.fetchone()
-        
-        now = datetime.now()
-        expires_at = (now + timedelta(days=days)).isoformat()
-        
-        if existing:
-            await db.execute("UPDATE users SET expires_at = ?, is_active = 1, trial_used = 1 WHERE user_id = ?", (expires_at, user_id))
-            await db.commit()
-            await sync_user_to_servers(existing[1], existing[0], "add")
-            return existing[0], existing[1]
-        else:
-            user_uuid = str(uuid.uuid4())
-            user_path = "u" + str(user_id)
-            await db.execute(
-                "INSERT INTO users (user_id, username, user_uuid, path, created_at, expires_at, is_active, trial_used) VALUES (?, ?, ?, ?, ?, ?, 1, 1)",
-                (user_id, username, user_uuid, user_path, now.isoformat(), expires_at)
-            )
-            await db.commit()
-            await sync_user_to_servers(user_uuid, user_path, "add")
-            await restart_xray()
-            return user_path, user_uuid
+async def check_trial_used(user_id):
+    cursor = await db.execute("SELECT trial_used FROM users WHERE user_id = ?", (user_id,))
+    row = await cursor.fetchone()
+    return row[0] == 1 if row else False
 
 
-async def add_days_to_user(user_id, days):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT expires_at FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        if not row:
-            return False
-        now = datetime.now()
-        old_expires = row[0]
-        if old_expires:
-            try:
-                old_exp = datetime.fromisoformat(old_expires)
-                new_expires = (old_exp + timedelta(days=days) if old_exp > now else now + timedelta(days=days)).isoformat()
-            except:
-                new_expires = (now + timedelta(days=days)).isoformat()
-        else:
-            return True
-        await db.execute("UPDATE users SET expires_at = ?, is_active = 1 WHERE user_id = ?", (new_expires, user_id))
+async def activate_trial(user_id, username, days):
+    now = datetime.now()
+    expires_at = (now + timedelta(days=days)).isoformat()
+    user_path = path_for(user_id)
+    new_uuid = str(uuid.uuid4())
+    async with db_lock:
+        cursor = await db.execute(
+            "INSERT INTO users (user_id, username, user_uuid, created_at, expires_at, expires_ts, is_active, trial_used) VALUES (?, ?, ?, ?, ?, ?, 1, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET expires_at = excluded.expires_at, expires_ts = excluded.expires_ts, is_active = 1, trial_used = 1 "
+            "RETURNING user_uuid",
+            (user_id, username, new_uuid, now.isoformat(), expires_at, to_epoch(expires_at))
+        )
+        user_uuid = (await cursor.fetchone())[0]
         await db.commit()
-        return True
-
-
-async def save_referral(referrer_id, referred_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        try:
-            await db.execute("INSERT INTO referrals (referrer_id, referred_id, created_at) VALUES (?, ?, ?)", (referrer_id, referred_id, datetime.now().isoformat()))
-            await db.execute("UPDATE users SET referred_by = ? WHERE user_id = ?", (referrer_id, referred_id))
-            await db.commit()
-            return True
-        except:
-            return False
-
-
-async def give_referral_bonus(referrer_id, referred_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT bonus_given FROM referrals WHERE referrer_id = ? AND referred_id = ?", (referrer_id, referred_id))
-        row = await cursor.fetchone()
-        if row and row[0] == 0:
-            await add_days_to_user(referrer_id, REFERRAL_BONUS_DAYS)
-            await db.execute("UPDATE referrals SET bonus_given = 1 WHERE referrer_id = ? AND referred_id = ?", (referrer_id, referred_id))
-            await db.commit()
-            return True
-        return False
+    invalidate_subscription(user_id)
+    schedule_expiry(expires_at, user_id)
+    await sync_user_to_servers(user_uuid, user_path, "add")
+    if user_uuid == new_uuid:
+        stats_cache["users"] += 1
+    await xray_add_user(user_uuid, user_id)
+    return user_path, user_uuid
+
+
+async def onboard_referred(user_id, username, referrer_id, days):
+    now = datetime.now()
+    expires_at = (now + timedelta(days=days)).isoformat()
+    user_path = path_for(user_id)
+    user_uuid = str(uuid.uuid4())
+    bonus = None
+    async with transaction():
+        cursor = await db.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, user_uuid, created_at, expires_at, expires_ts, is_active, trial_used, referred_by) VALUES (?, ?, ?, ?, ?, ?, 1, 1, ?)",
+            (user_id, username, user_uuid, now.isoformat(), expires_at, to_epoch(expires_at), referrer_id)
+        )
+        if not cursor.rowcount:
+            return None
+        cursor = await db.execute("INSERT OR IGNORE INTO referrals (referrer_id, referred_id, created_at, bonus_given) VALUES (?, ?, ?, 1)", (referrer_id, user_id, now.isoformat()))
+        rewarded = bool(cursor.rowcount)
+        if rewarded:
+            cursor = await db.execute("SELECT user_uuid, expires_ts, is_active AND (expires_ts IS NULL OR expires_ts >= ?) FROM users WHERE user_id = ? AND expires_at IS NOT NULL", (int(now.timestamp()), referrer_id))
+            row = await cursor.fetchone()
+            if row:
+                bonus = (row[0], extend_expiry(row[1], REFERRAL_BONUS_DAYS, now), row[2])
+                await db.execute("UPDATE users SET expires_at = ?, expires_ts = ?, is_active = 1 WHERE user_id = ?", (bonus[1], to_epoch(bonus[1]), referrer_id))
+    stats_cache["users"] += 1
+    if rewarded:
+        stats_cache["referrals"] += 1
+    invalidate_subscription(user_id)
+    schedule_expiry(expires_at, user_id)
+    adds = [xray_add_user(user_uuid, user_id)]
+    if bonus:
+        invalidate_subscription(referrer_id)
+        schedule_expiry(bonus[1], referrer_id)
+        if not bonus[2]:
+            adds.append(xray_add_user(bonus[0], referrer_id))
+    await sync_user_to_servers(user_uuid, user_path, "add")
+    await asyncio.gather(*adds)
+    return user_path, user_uuid, bool(bonus)
 
 
 async def get_referral_stats(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
-        count = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,))
-        row = await cursor.fetchone()
-        referred_by = row[0] if row else None
-        return count, referred_by
+    cursor = await db.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
+    count = (await cursor.fetchone())[0]
+    cursor = await db.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,))
+    row = await cursor.fetchone()
+    referred_by = row[0] if row else None
+    return count, referred_by
 
 
 async def check_user_exists(user_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT id FROM users WHERE user_id = ?", (user_id,))
-        return (await cursor.fetchone()) is not None
+    cursor = await db.execute("SELECT id FROM users WHERE user_id = ?", (user_id,))
+    return (await cursor.fetchone()) is not None
 
 
 async def create_subscription(user_id, username, days=None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT path, user_uuid, expires_at FROM users WHERE user_id = ?", (user_id,))
+    now = datetime.now()
+    user_path = path_for(user_id)
+    async with db_lock:
+        cursor = await db.execute("SELECT user_uuid, expires_ts, is_active AND (expires_ts IS NULL OR expires_ts >= ?) FROM users WHERE user_id = ?", (int(now.timestamp()), user_id))
         existing = await cursor.fetchone()
-        now = datetime.now()
-        
         if existing:
-            old_path, old_uuid, old_expires = existing
-            if old_expires and days:
-                try:
-                    old_exp = datetime.fromisoformat(old_expires)
-                    new_expires = ((old_exp if old_exp > now else now) + timedelta(days=days)).isoformat()
-                except:
-                    new_expires = (now + timedelta(days=days)).isoformat()
-            elif days:
-                new_expires = (now + timedelta(days=days)).isoformat()
-            else:
-                new_expires = None
-            await db.execute("UPDATE users SET expires_at = ?, is_active = 1 WHERE user_id = ?", (new_expires, user_id))
-            await db.commit()
-            await sync_user_to_servers(old_uuid, old_path, "add")
-            return old_path, old_uuid
+            user_uuid, old_ts, was_active = existing
+            expires_at = extend_expiry(old_ts, days, now) if days else None
+            await db.execute("UPDATE users SET expires_at = ?, expires_ts = ?, is_active = 1 WHERE user_id = ?", (expires_at, to_epoch(expires_at), user_id))
         else:
             user_uuid = str(uuid.uuid4())
-            user_path = "u" + str(user_id)
             expires_at = (now + timedelta(days=days)).isoformat() if days else None
             await db.execute(
-                "INSERT INTO users (user_id, username, user_uuid, path, created_at, expires_at, is_active) VALUES (?, ?, ?, ?, ?, ?, 1)",
-                (user_id, username, user_uuid, user_path, now.isoformat(), expires_at)
+                "INSERT INTO users (user_id, username, user_uuid, created_at, expires_at, expires_ts, is_active) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                (user_id, username, user_uuid, now.isoformat(), expires_at, to_epoch(expires_at))
             )
-            await db.commit()
-            await sync_user_to_servers(user_uuid, user_path, "add")
-            await restart_xray()
-            return user_path, user_uuid
+        await db.commit()
+    invalidate_subscription(user_id)
+    schedule_expiry(expires_at, user_id)
+    if existing and was_active:
+        return user_path, user_uuid, expires_at
+    await sync_user_to_servers(user_uuid, user_path, "add")
+    if not existing:
+        stats_cache["users"] += 1
+    await xray_add_user(user_uuid, user_id)
+    return user_path, user_uuid, expires_at
 
 
 async def activate_key(key, user_id, username):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT id, is_used, days, is_revoked FROM keys WHERE key = ?", (key,))
+    async with transaction():
+        cursor = await db.execute(
+            "SELECT k.id, k.is_used, k.days, k.is_revoked, u.user_uuid, u.expires_at FROM keys k LEFT JOIN users u ON u.user_id = ? WHERE k.key = ?",
+            (user_id, key)
+        )
         row = await cursor.fetchone()
         if not row:
-            return None, "Ключ не найден"
-        key_id, is_used, days, is_revoked = row
+            return None, None, "Ключ не найден"
+        key_id, is_used, days, is_revoked, existing_uuid, existing_expires = row
         if is_revoked:
-            return None, "Ключ аннулирован"
+            return None, None, "Ключ аннулирован"
         if is_used:
-            return None, "Ключ уже использован"
-        
-        cursor = await db.execute("SELECT path FROM users WHERE user_id = ?", (user_id,))
-        existing = await cursor.fetchone()
-        if existing:
-            return existing[0], None
+            return None, None, "Ключ уже использован"
+        if existing_uuid:
+            return existing_uuid, existing_expires, None
         
         user_uuid = str(uuid.uuid4())
-        user_path = "u" + str(user_id)
         now = datetime.now()
         expires_at = (now + timedelta(days=days)).isoformat() if days else None
         
         await db.execute(
-            "INSERT INTO users (user_id, username, user_uuid, path, key_id, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (user_id, username, user_uuid, user_path, key_id, now.isoformat(), expires_at)
+            "INSERT INTO users (user_id, username, user_uuid, key_id, created_at, expires_at, expires_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, username, user_uuid, key_id, now.isoformat(), expires_at, to_epoch(expires_at))
         )
         await db.execute(
-            "UPDATE keys SET is_used = 1, used_by = ?, used_by_username = ?, activated_at = ?, expires_at = ? WHERE key = ?",
-            (user_id, username, now.isoformat(), expires_at, key)
+            "UPDATE keys SET is_used = 1, used_by = ?, used_by_username = ?, activated_at = ?, expires_at = ? WHERE id = ?",
+            (user_id, username, now.isoformat(), expires_at, key_id)
         )
-        await db.commit()
-        await sync_user_to_servers(user_uuid, user_path, "add")
-        await restart_xray()
-        return user_path, None
+    invalidate_subscription(user_id)
+    schedule_expiry(expires_at, user_id)
+    stats_cache["users"] += 1
+    stats_cache["free_keys"] -= 1
+    await sync_user_to_servers(user_uuid, path_for(user_id), "add")
+    await xray_add_user(user_uuid, user_id)
+    return user_uuid, expires_at, None
 
 
 async def check_expired_users():
-    now = datetime.now().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET is_active = 0 WHERE expires_at IS NOT NULL AND expires_at < ? AND is_active = 1", (now,))
+    now = int(time.time())
+    async with db_lock:
+        cursor = await db.execute("UPDATE users SET is_active = 0 WHERE expires_ts IS NOT NULL AND expires_ts < ? AND is_active = 1 RETURNING user_uuid, user_id", (now,))
+        expired = await cursor.fetchall()
         await db.commit()
+    return expired
+
+
+async def lookup_subscription(user_id):
+    path = path_for(user_id)
+    cached = sub_cache.get(path)
+    if cached and time.monotonic() - cached[3] < SUB_CACHE_TTL:
+        return cached
+    async with read_pool.acquire() as conn:
+        cursor = await conn.execute("SELECT user_uuid, is_active, expires_ts FROM users WHERE user_id = ?", (user_id,))
+        row = await cursor.fetchone()
+    if not row:
+        return None
+    cached = sub_cache[path] = (*row, time.monotonic())
+    return cached
 
 
 async def get_user_info(user_id):
-    await check_expired_users()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT path, user_uuid, is_active, expires_at FROM users WHERE user_id = ?", (user_id,))
-        return await cursor.fetchone()
+    row = await lookup_subscription(user_id)
+    if not row:
+        return None
+    user_uuid, is_active, expires_ts = row[:3]
+    return user_uuid, is_active and (expires_ts is None or expires_ts >= int(time.time())), expires_ts
 
 
-async def get_all_users():
-    await check_expired_users()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_uuid, path FROM users WHERE is_active = 1")
-        return await cursor.fetchall()
+async def load_active_clients():
+    async with db_lock:
+        cursor = await db.execute("SELECT user_id, user_uuid FROM users WHERE is_active = 1 AND (expires_ts IS NULL OR expires_ts >= ?)", (int(time.time()),))
+        rows = await cursor.fetchall()
+    active_clients.clear()
+    active_clients.update(rows)
 
 
 async def get_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
+    global stats_inflight
+    if stats_snapshot and time.monotonic() - stats_snapshot[1] < STATS_CACHE_TTL:
+        return stats_snapshot[0]
+    if stats_inflight is None or stats_inflight.done():
+        stats_inflight = asyncio.ensure_future(fetch_stats())
+    return await asyncio.shield(stats_inflight)
+
+
+async def fetch_stats():
+    global stats_snapshot
+    now = time.monotonic()
+    async with read_pool.acquire() as conn:
+        cursor = await conn.execute("SELECT COUNT(*) FROM users WHERE is_active = 1")
         active = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        total = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM keys WHERE is_used = 0 AND is_revoked = 0")
-        free_keys = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM keys")
-        total_keys = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT SUM(amount) FROM payments")
-        row = await cursor.fetchone()
-        total_stars = row[0] if row[0] else 0
-        cursor = await db.execute("SELECT COUNT(*) FROM referrals")
-        total_refs = (await cursor.fetchone())[0]
-        return active, total, free_keys, total_keys, total_stars, total_refs
-
-
-async def get_keys_list():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT id, key, days, is_used, used_by_username, expires_at, is_revoked FROM keys ORDER BY id DESC LIMIT 20")
+    stats = (active, stats_cache["users"], stats_cache["free_keys"], stats_cache["keys"], stats_cache["stars"], stats_cache["referrals"])
+    stats_snapshot = (stats, now)
+    return stats
+
+
+async def get_keys_list(page=0):
+    async with read_pool.acquire() as conn:
+        cursor = await conn.execute(
+            "SELECT id, '[' || CASE WHEN is_revoked THEN 'X' WHEN is_used THEN 'V' ELSE 'O' END || '] #' || id || ' ' || "
+            "COALESCE(days || 'd', 'inf') || ' ' || COALESCE('@' || NULLIF(used_by_username, ''), CASE WHEN is_used THEN '?' ELSE '-' END) "
+            "FROM keys ORDER BY id DESC LIMIT ? OFFSET ?",
+            (KEYS_PAGE_SIZE + 1, page * KEYS_PAGE_SIZE)
+        )
         return await cursor.fetchall()
 
 
 async def get_key_info(key_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT id, key, days, is_used, used_by_username, expires_at, is_revoked FROM keys WHERE id = ?", (key_id,))
+    async with read_pool.acquire() as conn:
+        cursor = await conn.execute("SELECT id, key, days, is_used, used_by_username, expires_at, is_revoked FROM keys WHERE id = ?", (key_id,))
         return await cursor.fetchone()
 
 
 async def revoke_key(key_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_uuid, path FROM users WHERE key_id = ?", (key_id,))
+    async with transaction():
+        cursor = await db.execute("SELECT is_used, is_revoked FROM keys WHERE id = ?", (key_id,))
+        key_state = await cursor.fetchone()
+        cursor = await db.execute("SELECT user_uuid, user_id FROM users WHERE key_id = ?", (key_id,))
         user_info = await cursor.fetchone()
         await db.execute("UPDATE keys SET is_revoked = 1 WHERE id = ?", (key_id,))
         await db.execute("UPDATE users SET is_active = 0 WHERE key_id = ?", (key_id,))
-        await db.commit()
+    if key_state and not key_state[0] and not key_state[1]:
+        stats_cache["free_keys"] -= 1
     if user_info:
-        await sync_user_to_servers(user_info[0], user_info[1], "remove")
-    await restart_xray()
+        invalidate_subscription(user_info[1])
+        await sync_user_to_servers(user_info[0], path_for(user_info[1]), "remove")
+        await xray_remove_user(user_info[0], user_info[1])
 
 
 async def save_payment(user_id, username, amount, plan):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_lock:
         await db.execute("INSERT INTO payments (user_id, username, amount, plan, created_at) VALUES (?, ?, ?, ?, ?)", (user_id, username, amount, plan, datetime.now().isoformat()))
         await db.commit()
+    stats_cache["stars"] += amount
+
 
+def vless_inbound(clients):
+    return {
+        "tag": XRAY_INBOUND_TAG,
+        "port": XRAY_PORT,
+        "listen": "127.0.0.1",
+        "protocol": "vless",
+        "settings": {"clients": clients, "decryption": "none"},
+        "streamSettings": {"network": "tcp"}
+    }
+
+
+def client_digest(user_uuid):
+    return int.from_bytes(hashlib.blake2b(user_uuid.encode(), digest_size=16).digest(), "big")
 
-async def generate_xray_config():
-    users = await get_all_users()
-    clients = [{"id": user_uuid, "level": 0} for user_uuid, path in users]
+
+async def generate_xray_config(rewrite=False):
+    global xray_config_hash
+    clients = [{"id": user_uuid, "level": 0, "email": path_for(user_id)} for user_id, user_uuid in active_clients.items()]
+    clients_hash = 0
+    for client in clients:
+        clients_hash ^= client_digest(client["id"])
+    if clients and clients_hash == xray_config_hash and not rewrite:
+        return False
+    xray_config_hash = clients_hash
     if not clients:
         clients.append({"id": str(uuid.uuid4()), "level": 0})
     config = {
         "log": {"loglevel": "warning"},
-        "inbounds": [{
-            "port": XRAY_PORT,
-            "listen": "127.0.0.1",
-            "protocol": "vless",
-            "settings": {"clients": clients, "decryption": "none"},
-            "streamSettings": {"network": "ws", "wsSettings": {"path": "/tunnel"}}
-        }],
+        "api": {"tag": "api", "services": ["HandlerService"]},
+        "inbounds": [
+            vless_inbound(clients),
+            {"tag": "api", "port": XRAY_API_PORT, "listen": "127.0.0.1", "protocol": "dokodemo-door", "settings": {"address": "127.0.0.1"}}
+        ],
         "outbounds": [{"protocol": "freedom", "tag": "direct"}],
+        "routing": {"rules": [{"type": "field", "inboundTag": ["api"], "outboundTag": "api"}]},
         "dns": {"servers": ["8.8.8.8", "1.1.1.1"]}
     }
-    with open(XRAY_CONFIG_PATH, "w") as f:
-        json.dump(config, f, indent=2)
+    tmp_path = XRAY_CONFIG_PATH.with_suffix(".tmp")
+    tmp_path.write_bytes(orjson.dumps(config))
+    os.replace(tmp_path, XRAY_CONFIG_PATH)
+    return True
+
+
+def xray_running():
+    return xray_process is not None and xray_process.returncode is None
+
+
+async def wait_xray_ready():
+    deadline = time.monotonic() + XRAY_READY_TIMEOUT
+    while time.monotonic() < deadline and xray_running():
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", XRAY_PORT)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return True
+    return False
 
 
-def start_xray():
-    global xray_process
+async def start_xray():
+    global xray_process, xray_live_hash
     if not XRAY_CONFIG_PATH.exists():
         return False
     try:
-        xray_process = subprocess.Popen(["/usr/local/bin/xray", "run", "-config", str(XRAY_CONFIG_PATH)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except:
+        with open(XRAY_LOG_PATH, "ab") as log:
+            xray_process = await asyncio.create_subprocess_exec(XRAY_BIN, "run", "-config", str(XRAY_CONFIG_PATH), stdout=subprocess.DEVNULL, stderr=log, close_fds=False)
+    except OSError:
         return False
+    xray_live_hash = xray_config_hash
+    return await wait_xray_ready()
 
 
-def stop_xray():
-    global xray_process
-    if xray_process:
+async def stop_xray():
+    global xray_process, xray_live_hash
+    if xray_running():
         xray_process.terminate()
-        xray_process.wait()
-        xray_process = None
+        try:
+            await asyncio.wait_for(xray_process.wait(), 5)
+        except asyncio.TimeoutError:
+            xray_process.kill()
+            await xray_process.wait()
+    xray_process = None
+    xray_live_hash = None
+
+
+async def restart_xray(force=False):
+    async with xray_lock:
+        if force:
+            await load_active_clients()
+        running = xray_running()
+        await generate_xray_config(force or not running)
+        if not force and running and xray_config_hash == xray_live_hash:
+            return
+        await stop_xray()
+        await start_xray()
 
 
-async def restart_xray():
-    stop_xray()
-    await generate_xray_config()
-    await asyncio.sleep(1)
-    start_xray()
-    await asyncio.sleep(2)
+def fire_xray_reload():
+    global xray_reload_handle, xray_reload_task
+    xray_reload_handle = None
+    xray_reload_task = asyncio.get_running_loop().create_task(restart_xray())
+
+
+def schedule_xray_reload():
+    global xray_reload_handle
+    if xray_reload_handle:
+        xray_reload_handle.cancel()
+    xray_reload_handle = asyncio.get_running_loop().call_later(XRAY_RELOAD_DELAY, fire_xray_reload)
+
+
+async def xray_api(command, *args):
+    async with xray_api_semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(XRAY_BIN, "api", command, "-s", XRAY_API_ADDR, *args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return await proc.wait() == 0
+        except OSError:
+            return False
+
+
+async def xray_add_user(user_uuid, user_id):
+    global xray_live_hash
+    active_clients[user_id] = user_uuid
+    email = path_for(user_id)
+    digest = client_digest(user_uuid)
+    inbound_path = DATA_DIR / ("adu_" + uuid.uuid4().hex + ".json")
+    inbound_path.write_bytes(orjson.dumps({"inbounds": [vless_inbound([{"id": user_uuid, "level": 0, "email": email}])]}))
+    try:
+        if await xray_api("rmu", "-tag=" + XRAY_INBOUND_TAG, email) and xray_live_hash is not None:
+            xray_live_hash ^= digest
+        if await xray_api("adu", str(inbound_path)):
+            if xray_live_hash is not None:
+                xray_live_hash ^= digest
+        else:
+            xray_live_hash = None
+            schedule_xray_reload()
+    finally:
+        inbound_path.unlink(missing_ok=True)
+
+
+async def xray_remove_user(user_uuid, user_id):
+    global xray_live_hash
+    if active_clients.pop(user_id, None) is None:
+        return
+    if await xray_api("rmu", "-tag=" + XRAY_INBOUND_TAG, path_for(user_id)):
+        if xray_live_hash is not None:
+            xray_live_hash ^= client_digest(user_uuid)
+    else:
+        xray_live_hash = None
+        schedule_xray_reload()
+
+
+INDEX_BODY = "Nefrit VPN Master Server".encode()
+HEALTH_BODY_UP = orjson.dumps({"status": "ok", "xray": True})
+HEALTH_BODY_DOWN = orjson.dumps({"status": "ok", "xray": False})
 
 
 async def handle_index(request):
-    return web.Response(text="Nefrit VPN Master Server", content_type="text/html")
+    return web.Response(body=INDEX_BODY, content_type="text/html")
 
 
 async def handle_health(request):
-    xray_running = xray_process is not None and xray_process.poll() is None
-    return web.json_response({"status": "ok", "xray": xray_running})
+    return web.Response(body=HEALTH_BODY_UP if xray_running() else HEALTH_BODY_DOWN, content_type="application/json")
 
 
 async def handle_subscription(request):
     path = request.match_info["path"]
-    await check_expired_users()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_uuid, is_active, expires_at FROM users WHERE path = ?", (path,))
-        row = await cursor.fetchone()
+    if len(path) > 16 or not path.startswith("u") or not path[1:].isascii() or not path[1:].isdecimal():
+        return web.Response(text="Not found", status=404)
+    row = await lookup_subscription(int(path[1:]))
     if not row:
         return web.Response(text="Not found", status=404)
-    if not row[1]:
+    user_uuid, is_active, expires_ts = row[:3]
+    if not is_active or (expires_ts is not None and expires_ts <= time.time()):
         return web.Response(text="Expired", status=403)
-    if row[2]:
-        exp = datetime.fromisoformat(row[2])
-        if exp <= datetime.now():
-            return web.Response(text="Expired", status=403)
-    sub = generate_subscription_multi(row[0], path)
-    return web.Response(text=sub, content_type="text/plain", headers={"Profile-Update-Interval": "6"})
+    etag = subscription_etag(user_uuid, path)
+    headers = {"ETag": etag, "Profile-Update-Interval": "6"}
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers=headers)
+    sub = generate_subscription_multi(user_uuid, path)
+    return web.Response(text=sub, content_type="text/plain", headers=headers)
 
 
 async def handle_tunnel(request):
     if request.headers.get("Upgrade", "").lower() != "websocket":
         return web.Response(text="WS only", status=400)
-    ws_client = web.WebSocketResponse()
+    ws_client = web.WebSocketResponse(compress=False, max_msg_size=4 * TUNNEL_CHUNK)
     await ws_client.prepare(request)
     try:
-        url = "http://127.0.0.1:" + str(XRAY_PORT) + "/tunnel"
-        async with ClientSession() as session:
-            async with session.ws_connect(url, timeout=30) as ws_xray:
-                async def fwd(src, dst):
-                    try:
-                        async for msg in src:
-                            if msg.type == WSMsgType.BINARY:
-                                await dst.send_bytes(msg.data)
-                            elif msg.type == WSMsgType.TEXT:
-                                await dst.send_str(msg.data)
-                            elif msg.type in (WSMsgType.CLOSE, WSMsgType.ERROR):
-                                break
-                    except:
-                        pass
-                await asyncio.gather(fwd(ws_client, ws_xray), fwd(ws_xray, ws_client), return_exceptions=True)
-    except:
-        pass
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", XRAY_PORT), 30)
+    except (OSError, asyncio.TimeoutError):
+        await ws_client.close()
+        return ws_client
+    async def upstream():
+        async for msg in ws_client:
+            if msg.type == WSMsgType.BINARY:
+                writer.write(msg.data)
+                await writer.drain()
+            elif msg.type in (WSMsgType.CLOSE, WSMsgType.ERROR):
+                break
+    async def downstream():
+        while data := await reader.read(TUNNEL_CHUNK):
+            await ws_client.send_bytes(data)
+    tasks = [asyncio.ensure_future(upstream()), asyncio.ensure_future(downstream())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
     finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
         if not ws_client.closed:
             await ws_client.close()
     return ws_client
 
 
 def is_admin(user):
-    return user.username and user.username.lower() == ADMIN_USERNAME.lower()
+    return user.id in ADMIN_IDS or (bool(user.username) and user.username.lower() == ADMIN_USERNAME_LC)
+
+
+admin_router.callback_query.filter(F.from_user.func(is_admin))
+admin_router.message.filter(F.from_user.func(is_admin))
 
 
 def main_kb(admin=False):
@@ -549,10 +907,9 @@ def main_kb(admin=False):
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-async def buy_kb(user_id):
-    trial_used = await check_trial_used(user_id)
+def buy_kb(trial=False):
     buttons = []
-    if not trial_used:
+    if trial:
         buttons.append([InlineKeyboardButton(text="Пробный период (3 дня)", callback_data="trial")])
     buttons.extend([
         [InlineKeyboardButton(text="1 неделя - 5 звёзд", callback_data="pay_week")],
@@ -573,7 +930,7 @@ def admin_kb():
         [InlineKeyboardButton(text="Создать ключ", callback_data="newkey")],
         [InlineKeyboardButton(text="Все ключи", callback_data="keys")],
         [InlineKeyboardButton(text="Статистика", callback_data="stats")],
-        [InlineKeyboardButton(text="Перезапустить Xray", callback_data="restart_xray")],
+        [InlineKeyboardButton(text="Жёсткий перезапуск Xray", callback_data="restart_xray")],
         [InlineKeyboardButton(text="Назад", callback_data="back")]
     ])
 
@@ -600,23 +957,36 @@ def cancel_kb():
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="back")]])
 
 
+MAIN_KB_USER = main_kb(False)
+MAIN_KB_ADMIN = main_kb(True)
+BUY_KB = buy_kb(False)
+BUY_KB_TRIAL = buy_kb(True)
+TRIAL_CONFIRM_KB = trial_confirm_kb()
+ADMIN_KB = admin_kb()
+DAYS_KB = days_kb()
+BACK_KB = back_kb()
+BACK_ADMIN_KB = back_admin_kb()
+CANCEL_KB = cancel_kb()
+KEYS_BACK_ROW = [InlineKeyboardButton(text="Назад", callback_data="admin")]
+
+
+@functools.lru_cache(maxsize=512)
 def confirm_revoke_kb(key_id):
-    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Да, удалить", callback_data="confirmrev_" + str(key_id)), InlineKeyboardButton(text="Нет", callback_data="keys")]])
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Да, удалить", callback_data=RevokeCB(key_id=key_id).pack()), InlineKeyboardButton(text="Нет", callback_data="keys")]])
 
 
-def format_expiry(expires_at, is_revoked):
+def format_expiry(expires_at, is_revoked, now):
     if is_revoked:
         return "Аннулирован"
     if not expires_at:
         return "Бессрочно"
     try:
         exp = datetime.fromisoformat(expires_at)
-        now = datetime.now()
         if exp <= now:
             return "Истёк"
-        diff = (exp - now).days
-        return str(diff) + " дн." if diff > 0 else str((exp - now).seconds // 3600) + " ч."
-    except:
+        left = exp - now
+        return str(left.days) + " дн." if left.days > 0 else str(left.seconds // 3600) + " ч."
+    except ValueError:
         return "?"
 
 
@@ -631,8 +1001,8 @@ async def safe_send(message, text, reply_markup=None):
     await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
-@dp.message(CommandStart())
-async def cmd_start(msg: types.Message, command: CommandObject, state: FSMContext):
+@router.message(CommandStart())
+async def cmd_start(msg: types.Message, command: CommandObject, state: FSMContext, bot: Bot):
     await state.clear()
     user_id = msg.from_user.id
     username = msg.from_user.username or msg.from_user.first_name
@@ -647,60 +1017,58 @@ async def cmd_start(msg: types.Message, command: CommandObject, state: FSMContex
         except:
             referrer_id = None
     
-    user_exists = await check_user_exists(user_id)
+    onboarded = None
+    if referrer_id and not await check_user_exists(user_id):
+        onboarded = await onboard_referred(user_id, username, referrer_id, TRIAL_DAYS_REFERRAL)
     
-    if referrer_id and not user_exists:
-        await save_referral(referrer_id, user_id)
+    if onboarded:
+        path, user_uuid, bonus_applied = onboarded
         trial_days = TRIAL_DAYS_REFERRAL
-        path, user_uuid = await activate_trial(user_id, username, trial_days)
-        await give_referral_bonus(referrer_id, user_id)
-        await restart_xray()
         
         link = generate_vless_link_multi(user_uuid, SERVERS[0])
         sub_url = BASE_URL + "/sub/" + path
         
-        text = "<b>Добро пожаловать в Nefrit VPN!</b>\n\nВы пришли по реферальной ссылке!\nВам начислен пробный период на <b>" + str(trial_days) + " дней</b>!\n\n<b>Ссылка подписки:</b>\n<code>" + sub_url + "</code>\n\n<b>Конфиг:</b>\n<code>" + link + "</code>\n\n<b>Приложения:</b>\nAndroid: V2rayNG\niOS: Streisand / V2Box\nWindows: V2rayN"
+        text = REFERRAL_START_TEXT.format(days=trial_days, sub_url=sub_url, link=link)
         
-        await msg.answer(text, reply_markup=main_kb(is_admin(msg.from_user)), parse_mode="HTML")
+        await msg.answer(text, reply_markup=MAIN_KB_ADMIN if is_admin(msg.from_user) else MAIN_KB_USER, parse_mode="HTML")
         
-        try:
-            bonus_text = "Пользователь " + str(username) + " присоединился по вашей реферальной ссылке!\nВам начислено +" + str(REFERRAL_BONUS_DAYS) + " дней к подписке!"
-            await bot.send_message(referrer_id, bonus_text)
-        except:
-            pass
+        if bonus_applied:
+            try:
+                bonus_text = f"Пользователь {username} присоединился по вашей реферальной ссылке!\nВам начислено +{REFERRAL_BONUS_DAYS} дней к подписке!"
+                await bot.send_message(referrer_id, bonus_text)
+            except:
+                pass
         return
     
-    text = "<b>Nefrit VPN</b>\n\nДобро пожаловать, " + str(name) + "!\n\nБыстрый и надёжный VPN сервис.\n\nВыберите действие:"
-    await msg.answer(text, reply_markup=main_kb(is_admin(msg.from_user)), parse_mode="HTML")
+    text = START_TEXT.format(name=name)
+    await msg.answer(text, reply_markup=MAIN_KB_ADMIN if is_admin(msg.from_user) else MAIN_KB_USER, parse_mode="HTML")
 
 
-@dp.callback_query(F.data == "back")
+@router.callback_query(F.data == "back")
 async def go_back(cb: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await safe_edit(cb.message, "<b>Nefrit VPN</b>\n\nГлавное меню", main_kb(is_admin(cb.from_user)))
+    await safe_edit(cb.message, MENU_TEXT, MAIN_KB_ADMIN if is_admin(cb.from_user) else MAIN_KB_USER)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "buy")
+@router.callback_query(F.data == "buy")
 async def buy_menu(cb: types.CallbackQuery):
-    text = "<b>Купить подписку</b>\n\nВыберите тариф:\n\n1 неделя - 5 звёзд\n1 месяц - 10 звёзд\n1 год - 100 звёзд\nНавсегда - 300 звёзд\n\nОплата через Telegram Stars"
-    kb = await buy_kb(cb.from_user.id)
-    await safe_edit(cb.message, text, kb)
+    kb = BUY_KB if await check_trial_used(cb.from_user.id) else BUY_KB_TRIAL
+    await safe_edit(cb.message, BUY_TEXT, kb)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "trial")
+@router.callback_query(F.data == "trial")
 async def trial_menu(cb: types.CallbackQuery):
     trial_used = await check_trial_used(cb.from_user.id)
     if trial_used:
         await cb.answer("Вы уже использовали пробный период!", show_alert=True)
         return
-    text = "<b>Пробный период</b>\n\nАктивировать пробный период на <b>" + str(TRIAL_DAYS) + " дня</b>?\n\nПробный период можно использовать только один раз."
-    await safe_edit(cb.message, text, trial_confirm_kb())
+    await safe_edit(cb.message, TRIAL_TEXT, TRIAL_CONFIRM_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "trial_confirm")
+@router.callback_query(F.data == "trial_confirm")
 async def trial_confirm(cb: types.CallbackQuery):
     user_id = cb.from_user.id
     username = cb.from_user.username or cb.from_user.first_name
@@ -709,219 +1077,186 @@ async def trial_confirm(cb: types.CallbackQuery):
         await cb.answer("Вы уже использовали пробный период!", show_alert=True)
         return
     path, user_uuid = await activate_trial(user_id, username, TRIAL_DAYS)
-    await restart_xray()
     
     link = generate_vless_link_multi(user_uuid, SERVERS[0])
     sub_url = BASE_URL + "/sub/" + path
     exp = datetime.now() + timedelta(days=TRIAL_DAYS)
     exp_str = exp.strftime("%d.%m.%Y %H:%M")
     
-    text = "<b>Пробная подписка активирована!</b>\n\nДействует до: " + exp_str + "\n\n<b>Ссылка подписки:</b>\n<code>" + sub_url + "</code>\n\n<b>Конфиг:</b>\n<code>" + link + "</code>\n\n<b>Приложения:</b>\nAndroid: V2rayNG\niOS: Streisand / V2Box\nWindows: V2rayN"
-    await safe_edit(cb.message, text, back_kb())
+    text = f"<b>Пробная подписка активирована!</b>\n\nДействует до: {exp_str}\n\n<b>Ссылка подписки:</b>\n<code>{sub_url}</code>\n\n<b>Конфиг:</b>\n<code>{link}</code>\n\n<b>Приложения:</b>\nAndroid: V2rayNG\niOS: Streisand / V2Box\nWindows: V2rayN"
+    await safe_edit(cb.message, text, BACK_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "referral")
+@router.callback_query(F.data == "referral")
 async def referral_menu(cb: types.CallbackQuery):
     user_id = cb.from_user.id
     count, referred_by = await get_referral_stats(user_id)
-    ref_link = "https://t.me/" + BOT_USERNAME + "?start=ref_" + str(user_id)
-    
-    text = "<b>Реферальная система</b>\n\nПриглашайте друзей и получайте бонусы!\n\nЗа каждого приглашённого друга вы получите <b>+" + str(REFERRAL_BONUS_DAYS) + " дня</b> к подписке.\nВаш друг получит <b>" + str(TRIAL_DAYS_REFERRAL) + " дней</b> пробного периода!\n\nПриглашено людей: <b>" + str(count) + "</b>\n"
+    ref_link = f"https://t.me/{BOT_USERNAME}?start=ref_{user_id}"
     
-    if referred_by:
-        text += "Вас пригласил: <b>" + str(referred_by) + "</b>\n"
-    
-    text += "\n<b>Ваша реферальная ссылка:</b>\n<code>" + ref_link + "</code>"
-    await safe_edit(cb.message, text, back_kb())
+    invited_by = f"Вас пригласил: <b>{referred_by}</b>\n" if referred_by else ""
+    text = f"<b>Реферальная система</b>\n\nПриглашайте друзей и получайте бонусы!\n\nЗа каждого приглашённого друга вы получите <b>+{REFERRAL_BONUS_DAYS} дня</b> к подписке.\nВаш друг получит <b>{TRIAL_DAYS_REFERRAL} дней</b> пробного периода!\n\nПриглашено людей: <b>{count}</b>\n{invited_by}\n<b>Ваша реферальная ссылка:</b>\n<code>{ref_link}</code>"
+    await safe_edit(cb.message, text, BACK_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data.startswith("pay_"))
-async def process_payment(cb: types.CallbackQuery):
-    plan = cb.data.replace("pay_", "")
-    if plan not in PRICES:
+@router.callback_query(F.data.startswith("pay_"))
+async def process_payment(cb: types.CallbackQuery, bot: Bot):
+    invoice = PLAN_INVOICES.get(cb.data.removeprefix("pay_"))
+    if not invoice:
         await cb.answer("Ошибка", show_alert=True)
         return
-    price_info = PRICES[plan]
-    stars = price_info["stars"]
-    name = price_info["name"]
     await cb.answer()
-    await bot.send_invoice(cb.from_user.id, "Nefrit VPN - " + name, "Подписка на VPN: " + name, "vpn_" + plan, "", "XTR", [LabeledPrice(label=name, amount=stars)])
+    await bot.send_invoice(cb.from_user.id, **invoice)
 
 
-@dp.pre_checkout_query()
+@router.pre_checkout_query()
 async def pre_checkout(query: PreCheckoutQuery):
     await query.answer(ok=True)
 
 
-@dp.message(F.successful_payment)
+@router.message(F.successful_payment)
 async def successful_payment(msg: types.Message):
     payment = msg.successful_payment
-    payload = payment.invoice_payload
-    plan = payload.replace("vpn_", "")
-    if plan not in PRICES:
+    plan = payment.invoice_payload.removeprefix("vpn_")
+    price_info = PRICES.get(plan)
+    if not price_info:
         await msg.answer("Ошибка обработки платежа")
         return
-    price_info = PRICES[plan]
     days = price_info["days"]
     stars = price_info["stars"]
     username = msg.from_user.username or msg.from_user.first_name
-    await save_payment(msg.from_user.id, username, stars, plan)
-    path, user_uuid = await create_subscription(msg.from_user.id, username, days)
-    await restart_xray()
-    info = await get_user_info(msg.from_user.id)
-    if not info:
-        await msg.answer("Ошибка создания подписки")
-        return
-    expires_at = info[3]
+    _, (path, user_uuid, expires_at) = await asyncio.gather(
+        save_payment(msg.from_user.id, username, stars, plan),
+        create_subscription(msg.from_user.id, username, days)
+    )
     link = generate_vless_link_multi(user_uuid, SERVERS[0])
     sub_url = BASE_URL + "/sub/" + path
-    exp_str = "Действует до: " + datetime.fromisoformat(expires_at).strftime("%d.%m.%Y %H:%M") if expires_at else "Срок: Бессрочно"
-    text = "<b>Оплата принята!</b>\n\nСпасибо за покупку!\n\n" + exp_str + "\n\n<b>Ссылка подписки:</b>\n<code>" + sub_url + "</code>\n\n<b>Конфиг:</b>\n<code>" + link + "</code>\n\n<b>Приложения:</b>\nAndroid: V2rayNG\niOS: Streisand / V2Box\nWindows: V2rayN"
-    await msg.answer(text, reply_markup=back_kb(), parse_mode="HTML")
+    exp_str = "Действует до: " + format_exp(to_epoch(expires_at), int(time.time()))[0] if expires_at else "Срок: Бессрочно"
+    text = f"<b>Оплата принята!</b>\n\nСпасибо за покупку!\n\n{exp_str}\n\n<b>Ссылка подписки:</b>\n<code>{sub_url}</code>\n\n<b>Конфиг:</b>\n<code>{link}</code>\n\n<b>Приложения:</b>\nAndroid: V2rayNG\niOS: Streisand / V2Box\nWindows: V2rayN"
+    await msg.answer(text, reply_markup=BACK_KB, parse_mode="HTML")
 
 
-@dp.callback_query(F.data == "activate")
+@router.callback_query(F.data == "activate")
 async def activate(cb: types.CallbackQuery, state: FSMContext):
     await state.set_state(States.waiting_key)
-    text = "<b>Введите ключ активации:</b>\n\nПример: NEFRIT-A1B2C3D4E5F6G7H8"
-    await safe_edit(cb.message, text, cancel_kb())
+    await safe_edit(cb.message, ENTER_KEY_TEXT, CANCEL_KB)
     await cb.answer()
 
 
-@dp.message(States.waiting_key)
+@router.message(States.waiting_key)
 async def process_key(msg: types.Message, state: FSMContext):
     key = msg.text.strip().upper()
     username = msg.from_user.username or msg.from_user.first_name
-    path, error = await activate_key(key, msg.from_user.id, username)
+    user_uuid, expires_at, error = await activate_key(key, msg.from_user.id, username)
     await state.clear()
     if error:
-        await safe_send(msg, "Ошибка: " + error, back_kb())
-        return
-    info = await get_user_info(msg.from_user.id)
-    if not info:
-        await safe_send(msg, "Ошибка", back_kb())
+        await safe_send(msg, "Ошибка: " + error, BACK_KB)
         return
-    user_uuid = info[1]
-    expires_at = info[3]
     link = generate_vless_link_multi(user_uuid, SERVERS[0])
-    sub_url = BASE_URL + "/sub/" + path
-    exp_str = "Действует до: " + datetime.fromisoformat(expires_at).strftime("%d.%m.%Y %H:%M") if expires_at else "Срок: Бессрочно"
-    text = "<b>Подписка активирована!</b>\n\n" + exp_str + "\n\n<b>Ссылка:</b>\n<code>" + sub_url + "</code>\n\n<b>Конфиг:</b>\n<code>" + link + "</code>"
-    await safe_send(msg, text, back_kb())
+    sub_url = BASE_URL + "/sub/" + path_for(msg.from_user.id)
+    exp_str = "Действует до: " + format_exp(to_epoch(expires_at), int(time.time()))[0] if expires_at else "Срок: Бессрочно"
+    text = KEY_ACTIVATED_TEXT.format(expiry=exp_str, sub_url=sub_url, link=link)
+    await safe_send(msg, text, BACK_KB)
 
 
-@dp.callback_query(F.data == "mysub")
+@router.callback_query(F.data == "mysub")
 async def my_sub(cb: types.CallbackQuery):
     info = await get_user_info(cb.from_user.id)
     if not info:
-        text = "<b>У вас нет подписки</b>\n\nКупите или активируйте ключ."
-        await safe_edit(cb.message, text, back_kb())
+        await safe_edit(cb.message, NO_SUB_TEXT, BACK_KB)
         await cb.answer()
         return
-    user_path, user_uuid, is_active, expires_at = info
+    user_uuid, is_active, expires_ts = info
     link = generate_vless_link_multi(user_uuid, SERVERS[0])
-    sub_url = BASE_URL + "/sub/" + user_path
+    sub_url = BASE_URL + "/sub/" + path_for(cb.from_user.id)
     status = "Активна" if is_active else "Неактивна"
-    if expires_at:
-        exp = datetime.fromisoformat(expires_at)
-        now = datetime.now()
-        exp_str = exp.strftime("%d.%m.%Y") + " (" + str((exp - now).days) + " дн.)" if exp > now else "Истёк"
+    now_ts = int(time.time())
+    exp_date, days_left = format_exp(expires_ts, now_ts)
+    if days_left is None:
+        exp_str = exp_date
     else:
-        exp_str = "Бессрочно"
-    text = "<b>Ваша подписка</b>\n\nСтатус: " + status + "\nСрок: " + exp_str + "\n\n<b>Ссылка:</b>\n<code>" + sub_url + "</code>\n\n<b>Конфиг:</b>\n<code>" + link + "</code>"
-    await safe_edit(cb.message, text, back_kb())
+        exp_str = f"{exp_date} ({days_left} дн.)" if expires_ts > now_ts else "Истёк"
+    text = MY_SUB_TEXT.format(status=status, expiry=exp_str, sub_url=sub_url, link=link)
+    await safe_edit(cb.message, text, BACK_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "admin")
+@admin_router.callback_query(F.data == "admin")
 async def admin_panel(cb: types.CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
     await state.clear()
     active, total, free_keys, total_keys, total_stars, total_refs = await get_stats()
-    xray_ok = xray_process is not None and xray_process.poll() is None
-    xray_status = "Работает" if xray_ok else "Остановлен"
-    text = "<b>Админ-панель</b>\n\nПользователей: " + str(active) + " / " + str(total) + "\nКлючей: " + str(free_keys) + " / " + str(total_keys) + "\nЗаработано звёзд: " + str(total_stars) + "\nРефералов: " + str(total_refs) + "\nXray: " + xray_status
-    await safe_edit(cb.message, text, admin_kb())
+    xray_status = "Работает" if xray_running() else "Остановлен"
+    text = f"<b>Админ-панель</b>\n\nПользователей: {active} / {total}\nКлючей: {free_keys} / {total_keys}\nЗаработано звёзд: {total_stars}\nРефералов: {total_refs}\nXray: {xray_status}"
+    await safe_edit(cb.message, text, ADMIN_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "newkey")
+@admin_router.callback_query(F.data == "newkey")
 async def new_key_menu(cb: types.CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
     await state.set_state(States.waiting_days)
-    text = "<b>Создание ключа</b>\n\nВыберите срок действия:"
-    await safe_edit(cb.message, text, days_kb())
+    await safe_edit(cb.message, NEW_KEY_TEXT, DAYS_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data.startswith("mkkey_"))
+@admin_router.callback_query(F.data.startswith("mkkey_"))
 async def create_key_handler(cb: types.CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
     val = cb.data.replace("mkkey_", "")
     days = None if val == "0" else int(val)
-    days_str = "Бессрочно" if days is None else str(days) + " дней"
+    days_str = "Бессрочно" if days is None else f"{days} дней"
     await state.clear()
     key, key_id = await create_key(days)
-    text = "<b>Ключ создан!</b>\n\nID: #" + str(key_id) + "\nКлюч: <code>" + key + "</code>\nСрок: " + days_str
-    await safe_edit(cb.message, text, back_admin_kb())
+    text = f"<b>Ключ создан!</b>\n\nID: #{key_id}\nКлюч: <code>{key}</code>\nСрок: {days_str}"
+    await safe_edit(cb.message, text, BACK_ADMIN_KB)
     await cb.answer()
 
 
-@dp.message(States.waiting_days)
+@admin_router.message(States.waiting_days, F.text, ~F.text.startswith("/"))
 async def process_days_manual(msg: types.Message, state: FSMContext):
-    if not is_admin(msg.from_user):
+    parts = (msg.text or "").split()
+    if not 0 < len(parts) <= 2 or not all(part.isdecimal() for part in parts):
+        await safe_send(msg, "Введите число", BACK_ADMIN_KB)
         return
-    try:
-        days = int(msg.text.strip())
-        if days <= 0:
-            await safe_send(msg, "Введите положительное число", back_admin_kb())
-            return
-    except:
-        await safe_send(msg, "Введите число", back_admin_kb())
+    days = int(parts[0])
+    count = int(parts[1]) if len(parts) > 1 else 1
+    if days <= 0 or not 0 < count <= KEYS_BATCH_MAX:
+        await safe_send(msg, "Введите положительное число", BACK_ADMIN_KB)
         return
     await state.clear()
-    key, key_id = await create_key(days)
-    text = "<b>Ключ создан!</b>\n\nID: #" + str(key_id) + "\nКлюч: <code>" + key + "</code>\nСрок: " + str(days) + " дней"
-    await safe_send(msg, text, back_admin_kb())
+    if count == 1:
+        key, key_id = await create_key(days)
+        text = f"<b>Ключ создан!</b>\n\nID: #{key_id}\nКлюч: <code>{key}</code>\nСрок: {days} дней"
+    else:
+        keys = await create_keys(count, days)
+        key_lines = "\n".join(f"#{key_id} <code>{key}</code>" for key, key_id in keys)
+        text = f"<b>Создано ключей: {count}</b>\nСрок: {days} дней\n\n{key_lines}"
+    await safe_send(msg, text, BACK_ADMIN_KB)
 
 
-@dp.callback_query(F.data == "keys")
-async def list_keys(cb: types.CallbackQuery):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
-    keys = await get_keys_list()
+@admin_router.callback_query(F.data == "keys")
+@admin_router.callback_query(KeysPageCB.filter())
+async def list_keys(cb: types.CallbackQuery, callback_data: KeysPageCB = None):
+    page = callback_data.page if callback_data else 0
+    keys = await get_keys_list(page)
     if not keys:
-        await safe_edit(cb.message, "<b>Ключей нет</b>", back_admin_kb())
+        await safe_edit(cb.message, NO_KEYS_TEXT, BACK_ADMIN_KB)
         await cb.answer()
         return
-    text = "<b>Все ключи:</b>\n\nНажмите для удаления:"
-    buttons = []
-    for row in keys:
-        key_id, days, is_used, username, is_revoked = row[0], row[2], row[3], row[4], row[6]
-        status = "X" if is_revoked else ("V" if is_used else "O")
-        days_str = "inf" if days is None else str(days) + "d"
-        user_str = "@" + str(username) if username else ("?" if is_used else "-")
-        btn_text = "[" + status + "] #" + str(key_id) + " " + days_str + " " + user_str
-        buttons.append([InlineKeyboardButton(text=btn_text, callback_data="keyinfo_" + str(key_id))])
-    buttons.append([InlineKeyboardButton(text="Назад", callback_data="admin")])
-    await safe_edit(cb.message, text, InlineKeyboardMarkup(inline_keyboard=buttons))
+    buttons = [[InlineKeyboardButton.model_construct(text=label, callback_data=f"keyinfo_{key_id}")] for key_id, label in keys[:KEYS_PAGE_SIZE]]
+    nav = []
+    if page:
+        nav.append(InlineKeyboardButton.model_construct(text="◀", callback_data=KeysPageCB(page=page - 1).pack()))
+    if len(keys) > KEYS_PAGE_SIZE:
+        nav.append(InlineKeyboardButton.model_construct(text="▶", callback_data=KeysPageCB(page=page + 1).pack()))
+    if nav:
+        buttons.append(nav)
+    buttons.append(KEYS_BACK_ROW)
+    await safe_edit(cb.message, KEYS_LIST_TEXT, InlineKeyboardMarkup.model_construct(inline_keyboard=buttons))
     await cb.answer()
 
 
-@dp.callback_query(F.data.startswith("keyinfo_"))
+@admin_router.callback_query(F.data.startswith("keyinfo_"))
 async def key_info(cb: types.CallbackQuery):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
     key_id = int(cb.data.replace("keyinfo_", ""))
     info = await get_key_info(key_id)
     if not info:
@@ -929,86 +1264,137 @@ async def key_info(cb: types.CallbackQuery):
         return
     key, days, is_used, username, expires_at, is_revoked = info[1], info[2], info[3], info[4], info[5], info[6]
     status = "Аннулирован" if is_revoked else ("Использован" if is_used else "Свободен")
-    days_str = "Бессрочно" if days is None else str(days) + " дней"
-    user_str = "@" + str(username) if username else "-"
-    exp_str = format_expiry(expires_at, is_revoked)
-    text = "<b>Ключ #" + str(key_id) + "</b>\n\nКлюч: <code>" + str(key) + "</code>\nСтатус: " + status + "\nСрок: " + days_str + "\nПользователь: " + user_str + "\nОсталось: " + exp_str + "\n\n"
+    days_str = "Бессрочно" if days is None else f"{days} дней"
+    user_str = f"@{username}" if username else "-"
+    exp_str = format_expiry(expires_at, is_revoked, datetime.now())
+    text = f"<b>Ключ #{key_id}</b>\n\nКлюч: <code>{key}</code>\nСтатус: {status}\nСрок: {days_str}\nПользователь: {user_str}\nОсталось: {exp_str}\n\n"
     if not is_revoked:
-        text += "Удалить этот ключ?"
-        await safe_edit(cb.message, text, confirm_revoke_kb(key_id))
+        await safe_edit(cb.message, text + "Удалить этот ключ?", confirm_revoke_kb(key_id))
     else:
-        await safe_edit(cb.message, text, back_admin_kb())
+        await safe_edit(cb.message, text, BACK_ADMIN_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data.startswith("confirmrev_"))
-async def confirm_revoke(cb: types.CallbackQuery):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
-    key_id = int(cb.data.replace("confirmrev_", ""))
+@admin_router.callback_query(RevokeCB.filter())
+async def confirm_revoke(cb: types.CallbackQuery, callback_data: RevokeCB):
+    key_id = callback_data.key_id
     await revoke_key(key_id)
-    text = "<b>Ключ #" + str(key_id) + " аннулирован!</b>\n\nПользователь потерял доступ."
-    await safe_edit(cb.message, text, back_admin_kb())
+    text = f"<b>Ключ #{key_id} аннулирован!</b>\n\nПользователь потерял доступ."
+    await safe_edit(cb.message, text, BACK_ADMIN_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "stats")
+@admin_router.callback_query(F.data == "stats")
 async def stats_handler(cb: types.CallbackQuery):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
-    active, total, free_keys, total_keys, total_stars, total_refs = await get_stats()
-    text = "<b>Статистика</b>\n\n<b>Пользователи:</b>\nАктивных: " + str(active) + "\nВсего: " + str(total) + "\n\n<b>Ключи:</b>\nСвободных: " + str(free_keys) + "\nВсего: " + str(total_keys) + "\n\n<b>Доход:</b>\nВсего звёзд: " + str(total_stars) + "\n\n<b>Рефералы:</b>\nВсего приглашений: " + str(total_refs)
-    await safe_edit(cb.message, text, back_admin_kb())
+    await safe_edit(cb.message, STATS_TEXT.format(*await get_stats()), BACK_ADMIN_KB)
     await cb.answer()
 
 
-@dp.callback_query(F.data == "restart_xray")
+@admin_router.callback_query(F.data == "restart_xray")
 async def restart_xray_handler(cb: types.CallbackQuery):
-    if not is_admin(cb.from_user):
-        await cb.answer("Нет доступа", show_alert=True)
-        return
     await cb.answer("Перезапуск...")
-    await restart_xray()
-    await safe_edit(cb.message, "<b>Xray перезапущен!</b>", back_admin_kb())
+    await restart_xray(force=True)
+    await safe_edit(cb.message, XRAY_RESTARTED_TEXT, BACK_ADMIN_KB)
+
+
+@router.callback_query(F.data.in_({"admin", "newkey", "keys", "stats", "restart_xray"}))
+@router.callback_query(F.data.startswith(("mkkey_", "keyinfo_")))
+@router.callback_query(RevokeCB.filter())
+@router.callback_query(KeysPageCB.filter())
+async def admin_denied(cb: types.CallbackQuery):
+    await cb.answer("Нет доступа", show_alert=True)
 
 
 async def run_bot():
-    print("Bot starting...")
-    await dp.start_polling(bot)
+    bot = Bot(token=BOT_TOKEN, session=BotSession())
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_routers(admin_router, router)
+    logger.info("Bot starting")
+    await dp.start_polling(bot, handle_signals=False)
+
+
+@web.middleware
+async def limit_concurrency(request, handler):
+    if request.path == "/tunnel":
+        return await handler(request)
+    async with web_semaphore:
+        return await handler(request)
 
 
 async def run_web():
-    app = web.Application()
+    app = web.Application(middlewares=[limit_concurrency], client_max_size=8192)
     app.router.add_get("/", handle_index)
     app.router.add_get("/health", handle_health)
     app.router.add_get("/sub/{path}", handle_subscription)
     app.router.add_get("/tunnel", handle_tunnel)
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    site = web.TCPSite(runner, "0.0.0.0", PORT, backlog=2048)
     await site.start()
-    print("Web on port " + str(PORT))
-    while True:
-        await asyncio.sleep(3600)
+    logger.info("Web on port %d", PORT)
+    try:
+        await shutdown_event.wait()
+    finally:
+        await runner.cleanup()
 
 
 async def expiry_checker():
+    async with db_lock:
+        cursor = await db.execute("SELECT expires_ts, user_id FROM users WHERE is_active = 1 AND expires_ts IS NOT NULL")
+        rows = await cursor.fetchall()
+    expiry_heap.extend(rows)
+    heapq.heapify(expiry_heap)
     while True:
-        await asyncio.sleep(3600)
-        await check_expired_users()
-        await restart_xray()
+        timeout = expiry_heap[0][0] + 1 - time.time() if expiry_heap else 3600
+        try:
+            await asyncio.wait_for(expiry_event.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+        expiry_event.clear()
+        now = int(time.time())
+        if not expiry_heap or expiry_heap[0][0] >= now:
+            continue
+        due = []
+        while expiry_heap and expiry_heap[0][0] < now:
+            due.append(heapq.heappop(expiry_heap))
+        try:
+            expired = await check_expired_users()
+            await asyncio.gather(*(xray_remove_user(user_uuid, user_id) for user_uuid, user_id in expired))
+        except Exception:
+            logger.exception("Expiry pass failed")
+            for _, user_id in due:
+                heapq.heappush(expiry_heap, (now + 60, user_id))
 
 
 async def main():
-    print("NEFRIT VPN MASTER SERVER")
+    global http_session
+    log_listener.start()
+    logger.info("NEFRIT VPN MASTER SERVER")
+    http_session = ClientSession(connector=TCPConnector(limit=0, ttl_dns_cache=600, keepalive_timeout=300))
     await init_db()
     await generate_xray_config()
-    start_xray()
-    await asyncio.sleep(3)
-    await asyncio.gather(run_web(), run_bot(), expiry_checker())
+    await start_xray()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown_event.set)
+    tasks = [asyncio.create_task(run_bot()), asyncio.create_task(expiry_checker())]
+    for task in tasks:
+        task.add_done_callback(lambda task: shutdown_event.set())
+    try:
+        await run_web()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error("Task failed", exc_info=result)
+        await stop_xray()
+        await close_db()
+        await http_session.close()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
+    if uvloop:
+        uvloop.install()
     asyncio.run(main())
@@ -1,15 +1,23 @@
 import os
-import json
 import uuid
 import asyncio
+import signal
 import subprocess
 from pathlib import Path
 from datetime import datetime
-from aiohttp import web, WSMsgType, ClientSession
+from aiohttp import web, WSMsgType, ClientSession, TCPConnector
 import aiosqlite
+import orjson
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 PORT = int(os.getenv("PORT", 8080))
 XRAY_PORT = 10001
+XRAY_API_PORT = 10085
+XRAY_INBOUND_TAG = "vless-in"
+XRAY_BIN = "/usr/local/bin/xray"
 SERVER_SECRET = os.getenv("SERVER_SECRET", "default-secret")
 SERVER_NAME = os.getenv("SERVER_NAME", "Worker Server")
 
@@ -22,43 +30,58 @@ else:
 DATA_DIR.mkdir(exist_ok=True)
 DB_PATH = DATA_DIR / "worker.db"
 XRAY_CONFIG_PATH = DATA_DIR / "xray_config.json"
+XRAY_LOG_PATH = DATA_DIR / "xray.log"
 
 print(f"📁 Data directory: {DATA_DIR}")
 print(f"📁 Database: {DB_PATH}")
 
 xray_process = None
 restart_lock = asyncio.Lock()
+shutdown_event = asyncio.Event()
+db = None
+db_lock = asyncio.Lock()
 
 
 async def init_db():
     """Инициализация базы данных worker-сервера"""
+    global db
     print("🔧 Initializing worker database...")
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("PRAGMA journal_mode=WAL")
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_uuid TEXT UNIQUE NOT NULL,
-                path TEXT NOT NULL,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        await db.commit()
-        
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        count = (await cursor.fetchone())[0]
-        print(f"✅ Worker DB initialized. Users: {count}")
+    db = await aiosqlite.connect(DB_PATH)
+    await db.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+    """)
+    
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_uuid TEXT UNIQUE NOT NULL,
+            path TEXT NOT NULL,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    await db.commit()
+    
+    cursor = await db.execute("SELECT COUNT(*) FROM users")
+    count = (await cursor.fetchone())[0]
+    print(f"✅ Worker DB initialized. Users: {count}")
+
+
+async def close_db():
+    """Закрытие соединения с БД"""
+    if db:
+        await db.close()
 
 
 async def get_all_users():
     """Получить всех пользователей из БД"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute("SELECT user_uuid, path FROM users")
-            return await cursor.fetchall()
+        cursor = await db.execute("SELECT user_uuid, path FROM users")
+        return await cursor.fetchall()
     except Exception as e:
         print(f"❌ Error getting users: {e}")
         return []
@@ -66,49 +89,67 @@ async def get_all_users():
 
 async def add_user(user_uuid, user_path):
     """Добавить пользователя в БД"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
+    async with db_lock:
+        try:
             await db.execute(
                 "INSERT OR REPLACE INTO users (user_uuid, path, added_at) VALUES (?, ?, ?)",
                 (user_uuid, user_path, datetime.now().isoformat())
             )
             await db.commit()
-            print(f"✅ User added/updated: {user_uuid[:16]}...")
-            return True
-    except Exception as e:
-        print(f"❌ Error adding user: {e}")
-        return False
+        except Exception as e:
+            await db.rollback()
+            print(f"❌ Error adding user: {e}")
+            return False
+    print(f"✅ User added/updated: {user_uuid[:16]}...")
+    return True
 
 
 async def remove_user(user_uuid):
     """Удалить пользователя из БД"""
-    try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT id FROM users WHERE user_uuid = ?", (user_uuid,)
-            )
-            exists = await cursor.fetchone()
-            
-            if exists:
-                await db.execute("DELETE FROM users WHERE user_uuid = ?", (user_uuid,))
-                await db.commit()
-                print(f"✅ User removed: {user_uuid[:16]}...")
-                return True
-            else:
-                print(f"⚠️ User not found: {user_uuid[:16]}...")
-                return False
-    except Exception as e:
-        print(f"❌ Error removing user: {e}")
+    async with db_lock:
+        try:
+            cursor = await db.execute("DELETE FROM users WHERE user_uuid = ?", (user_uuid,))
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            print(f"❌ Error removing user: {e}")
+            return False
+    
+    if cursor.rowcount:
+        print(f"✅ User removed: {user_uuid[:16]}...")
+        return True
+    else:
+        print(f"⚠️ User not found: {user_uuid[:16]}...")
         return False
 
 
+def vless_inbound(clients):
+    """Описание VLESS inbound (для конфига и для API)"""
+    return {
+        "tag": XRAY_INBOUND_TAG,
+        "port": XRAY_PORT,
+        "listen": "127.0.0.1",
+        "protocol": "vless",
+        "settings": {
+            "clients": clients,
+            "decryption": "none"
+        },
+        "streamSettings": {
+            "network": "ws",
+            "wsSettings": {
+                "path": "/tunnel"
+            }
+        }
+    }
+
+
 async def generate_xray_config():
     """Генерация конфигурации Xray из БД"""
     users = await get_all_users()
     
     clients = []
     for user_uuid, path in users:
-        clients.append({"id": user_uuid, "level": 0})
+        clients.append({"id": user_uuid, "level": 0, "email": user_uuid})
     
     if not clients:
         dummy_uuid = str(uuid.uuid4())
@@ -119,20 +160,19 @@ async def generate_xray_config():
         "log": {
             "loglevel": "warning"
         },
+        "api": {
+            "tag": "api",
+            "services": ["HandlerService"]
+        },
         "inbounds": [
+            vless_inbound(clients),
             {
-                "port": XRAY_PORT,
+                "tag": "api",
+                "port": XRAY_API_PORT,
                 "listen": "127.0.0.1",
-                "protocol": "vless",
+                "protocol": "dokodemo-door",
                 "settings": {
-                    "clients": clients,
-                    "decryption": "none"
-                },
-                "streamSettings": {
-                    "network": "ws",
-                    "wsSettings": {
-                        "path": "/tunnel"
-                    }
+                    "address": "127.0.0.1"
                 }
             }
         ],
@@ -142,13 +182,23 @@ async def generate_xray_config():
                 "tag": "direct"
             }
         ],
+        "routing": {
+            "rules": [
+                {
+                    "type": "field",
+                    "inboundTag": ["api"],
+                    "outboundTag": "api"
+                }
+            ]
+        },
         "dns": {
             "servers": ["8.8.8.8", "1.1.1.1"]
         }
     }
     
-    with open(XRAY_CONFIG_PATH, "w") as f:
-        json.dump(config, f, indent=2)
+    tmp_path = XRAY_CONFIG_PATH.with_suffix(".tmp")
+    tmp_path.write_bytes(orjson.dumps(config))
+    os.replace(tmp_path, XRAY_CONFIG_PATH)
     
     print(f"📝 Xray config: {len(clients)} clients")
     return len(clients)
@@ -167,11 +217,13 @@ def start_xray():
             print("⚠️ Xray already running")
             return True
         
-        xray_process = subprocess.Popen(
-            ["/usr/local/bin/xray", "run", "-config", str(XRAY_CONFIG_PATH)],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        # Вывод Xray не читаем: PIPE переполнится и процесс зависнет
+        with open(XRAY_LOG_PATH, "ab") as log:
+            xray_process = subprocess.Popen(
+                [XRAY_BIN, "run", "-config", str(XRAY_CONFIG_PATH)],
+                stdout=subprocess.DEVNULL,
+                stderr=log
+            )
         
         print(f"✅ Xray started with PID {xray_process.pid}")
         return True
@@ -213,6 +265,38 @@ async def restart_xray():
         await asyncio.sleep(1)
 
 
+async def xray_api(command, *args):
+    """Вызов Xray API (без перезапуска процесса)"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            XRAY_BIN, "api", command, "-s", f"127.0.0.1:{XRAY_API_PORT}", *args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        return await proc.wait() == 0
+    except Exception as e:
+        print(f"❌ Xray API error: {e}")
+        return False
+
+
+async def xray_add_client(user_uuid):
+    """Добавить клиента в работающий Xray"""
+    inbound_path = DATA_DIR / f"adu_{uuid.uuid4().hex}.json"
+    inbound_path.write_bytes(orjson.dumps({
+        "inbounds": [vless_inbound([{"id": user_uuid, "level": 0, "email": user_uuid}])]
+    }))
+    try:
+        await xray_api("rmu", f"-tag={XRAY_INBOUND_TAG}", user_uuid)
+        return await xray_api("adu", str(inbound_path))
+    finally:
+        inbound_path.unlink(missing_ok=True)
+
+
+async def xray_remove_client(user_uuid):
+    """Удалить клиента из работающего Xray"""
+    return await xray_api("rmu", f"-tag={XRAY_INBOUND_TAG}", user_uuid)
+
+
 # ============= WEB HANDLERS =============
 
 async def handle_index(request):
@@ -263,7 +347,9 @@ async def handle_add_user(request):
     success = await add_user(user_uuid, user_path)
     
     if success:
-        await restart_xray()
+        if not await xray_add_client(user_uuid):
+            print("⚠️ Xray API failed, restarting...")
+            await restart_xray()
         users = await get_all_users()
         return web.json_response({
             "success": True,
@@ -295,7 +381,9 @@ async def handle_remove_user(request):
     
     success = await remove_user(user_uuid)
     
-    await restart_xray()
+    if success and not await xray_remove_client(user_uuid):
+        print("⚠️ Xray API failed, restarting...")
+        await restart_xray()
     users = await get_all_users()
     
     return web.json_response({
@@ -318,19 +406,24 @@ async def handle_sync(request):
     
     print(f"🔄 Full sync: {len(users_list)} users")
     
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM users")
-        
-        for user in users_list:
-            user_uuid = user.get("uuid")
-            user_path = user.get("path", "")
-            if user_uuid:
-                await db.execute(
-                    "INSERT INTO users (user_uuid, path, added_at) VALUES (?, ?, ?)",
-                    (user_uuid, user_path, datetime.now().isoformat())
-                )
-        
-        await db.commit()
+    added_at = datetime.now().isoformat()
+    rows = [
+        (user["uuid"], user.get("path", ""), added_at)
+        for user in users_list
+        if user.get("uuid")
+    ]
+    
+    async with db_lock:
+        try:
+            await db.execute("DELETE FROM users")
+            await db.executemany(
+                "INSERT OR REPLACE INTO users (user_uuid, path, added_at) VALUES (?, ?, ?)",
+                rows
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
     
     await restart_xray()
     
@@ -356,12 +449,10 @@ async def handle_tunnel(request):
     ws_client = web.WebSocketResponse()
     await ws_client.prepare(request)
     
-    session = None
     ws_xray = None
     
     try:
-        session = ClientSession()
-        ws_xray = await session.ws_connect(
+        ws_xray = await request.app["xray_session"].ws_connect(
             f"http://127.0.0.1:{XRAY_PORT}/tunnel",
             timeout=30
         )
@@ -390,20 +481,33 @@ async def handle_tunnel(request):
     finally:
         if ws_xray and not ws_xray.closed:
             await ws_xray.close()
-        if session:
-            await session.close()
         if not ws_client.closed:
             await ws_client.close()
     
     return ws_client
 
 
+async def create_xray_session(app):
+    """Общая HTTP-сессия для подключений к локальному Xray"""
+    app["xray_session"] = ClientSession(
+        connector=TCPConnector(limit=0, keepalive_timeout=60)
+    )
+
+
+async def close_xray_session(app):
+    await app["xray_session"].close()
+
+
 # ============= BACKGROUND =============
 
 async def health_checker():
     """Проверка Xray каждые 60 сек"""
     while True:
-        await asyncio.sleep(60)
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=60)
+            return
+        except asyncio.TimeoutError:
+            pass
         try:
             if not xray_process or xray_process.poll() is not None:
                 print("⚠️ Xray down, restarting...")
@@ -422,6 +526,8 @@ async def run_web():
     app.router.add_post("/api/remove_user", handle_remove_user)
     app.router.add_post("/api/sync", handle_sync)
     app.router.add_get("/tunnel", handle_tunnel)
+    app.on_startup.append(create_xray_session)
+    app.on_cleanup.append(close_xray_session)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -430,8 +536,10 @@ async def run_web():
     
     print(f"🌐 {SERVER_NAME} on port {PORT}")
     
-    while True:
-        await asyncio.sleep(3600)
+    try:
+        await shutdown_event.wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
@@ -445,12 +553,19 @@ async def main():
     start_xray()
     await asyncio.sleep(2)
     
-    await asyncio.gather(run_web(), health_checker())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown_event.set)
+    
+    try:
+        await asyncio.gather(run_web(), health_checker())
+    finally:
+        stop_xray()
+        await close_db()
+        print("👋 Bye")
 
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("\n👋 Bye")
-        stop_xray()
+    if uvloop:
+        uvloop.install()
+    asyncio.run(main())